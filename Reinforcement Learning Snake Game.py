@@ -1,9 +1,15 @@
 import pickle
-import random
+from collections import defaultdict, deque
 import tkinter as tk
 from tkinter import ttk
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:  # Numba is optional, the Q-learning kernel also runs as plain Python
+    def njit(**kwargs):
+        return lambda func: func
+
 # Game settings
 GAME_WIDTH = 700
 GAME_HEIGHT = 600
@@ -11,6 +17,12 @@ SNAKE_SIZE = 20
 FOOD_SIZE = 20
 BACKGROUND_COLOR = "#000000"
 ACTIONS = ['Left', 'Right', 'Up', 'Down']
+DIRECTION_DELTAS = {
+    'Left': (-SNAKE_SIZE, 0),
+    'Right': (SNAKE_SIZE, 0),
+    'Up': (0, -SNAKE_SIZE),
+    'Down': (0, SNAKE_SIZE)
+}
 
 # Parameters for Q-learning
 GAMMA = 0.9  # Discount factor
@@ -19,6 +31,8 @@ ALPHA = 0.1  # Learning rate
 EPSILON = 0.5  # Initial exploration rate
 EPSILON_DECAY = 0.99  # Exploration decay rate
 EPSILON_MIN = 0.01  # Minimum exploration rate
+MIN_Q_UPDATE = 1e-6  # Smallest update that adds an unseen state to the Q-table
+RANDOM_BUFFER_SIZE = 4096  # Number of random draws generated at once
 
 # Game speeds (in milliseconds)
 SPEEDS = {
@@ -26,6 +40,7 @@ SPEEDS = {
     "Normal": 100,
     "Fast": 50
 }
+HEADLESS_BATCH_SIZE = 200  # Game steps per callback while rendering is off
 
 # Reward values
 REWARDS = {
@@ -36,116 +51,155 @@ REWARDS = {
     "FARTHER_FROM_FOOD": -0.5
 }
 
+# Valid action indices and masks for each value of the four danger bits in a packed state,
+# falling back to all actions when every direction is dangerous
+VALID_ACTIONS = [
+    [i for i in range(len(ACTIONS)) if not danger_bits >> i & 1] or list(range(len(ACTIONS)))
+    for danger_bits in range(1 << len(ACTIONS))
+]
+VALID_ACTION_MASKS = np.array([[i in valid_actions for i in range(len(ACTIONS))] for valid_actions in VALID_ACTIONS])
+
+# Shared Q-values for states that are not in the Q-table yet
+ZERO_Q_VALUES = np.zeros(len(ACTIONS), dtype=np.float32)
+ZERO_Q_VALUES.flags.writeable = False
+
+@njit(cache=True)
+def q_delta(q_values, next_q_values, action_index, reward, alpha, gamma):
+    """Return the Q-learning update for q_values[action_index]."""
+    return alpha * (reward + gamma * next_q_values.max() - q_values[action_index])
+
 class QLearningSnakeAgent:
-    def __init__(self, state_size, action_size, q_table_file="q_table.pkl"):
-        self.q_table = {}  # Initialize Q-table
+    def __init__(self, state_size, action_size, q_table_file="q_table.pkl", save_every=50):
+        self.q_table = defaultdict(lambda: np.zeros(len(ACTIONS), dtype=np.float32))  # Initialize Q-table
         self.state_size = state_size
         self.action_size = action_size
         self.q_table_file = q_table_file  # File where Q-table will be saved/loaded from
+        self.save_every = save_every  # Number of episodes between Q-table saves
+        self.episode = 0
+        self.epsilon = EPSILON  # Exploration rate, decayed after every episode
+        self.epsilon_min = EPSILON_MIN
+        self.epsilon_decay = EPSILON_DECAY
+
+        # Random numbers are drawn in batches and handed out one per call
+        self.rng = np.random.default_rng()
+        self.random_buffer = self.rng.random(RANDOM_BUFFER_SIZE)
+        self.random_index = 0
 
         # Try to load the Q-table if it exists
         self.load_q_table()
 
+        # Compile the update kernel up front instead of on the first game step,
+        # for both stored Q-values and the read-only shared default
+        for q_values in (np.zeros(len(ACTIONS), dtype=np.float32), ZERO_Q_VALUES):
+            for next_q_values in (np.zeros(len(ACTIONS), dtype=np.float32), ZERO_Q_VALUES):
+                q_delta(q_values, next_q_values, 0, 0.0, ALPHA, GAMMA)
+
     def save_q_table(self):
         """Save the Q-table to a file."""
         with open(self.q_table_file, 'wb') as file:
-            pickle.dump(self.q_table, file)
+            # A defaultdict with a lambda factory can't be pickled, so save a plain dict
+            pickle.dump(dict(self.q_table), file, protocol=pickle.HIGHEST_PROTOCOL)
         print("Q-table saved.")
 
     def load_q_table(self):
         """Load the Q-table from a file if it exists."""
         try:
             with open(self.q_table_file, 'rb') as file:
-                self.q_table = pickle.load(file)
+                q_table = pickle.load(file)
             print("Q-table loaded from file.")
         except FileNotFoundError:
             print("No Q-table found, starting with a new table.")
-
-    def get_state(self, snake, food):
-        """Convert game state (snake and food positions) into a simplified representation."""
+            return
+
+        # Older Q-tables used tuples of booleans as keys and lists as values; convert them to the current layout
+        for state, q_values in q_table.items():
+            if isinstance(state, tuple):
+                # The last three booleans were the close/medium/far flags, which map to distance buckets 0-3
+                state = sum(bool(bit) << i for i, bit in enumerate(state[:8])) | (3 - sum(map(bool, state[8:]))) << 8
+            self.q_table[state] = np.asarray(q_values, dtype=np.float32)
+
+    def random_uniform(self):
+        """Return the next uniform random number in [0, 1) from the buffer."""
+        if self.random_index == RANDOM_BUFFER_SIZE:
+            self.random_buffer = self.rng.random(RANDOM_BUFFER_SIZE)
+            self.random_index = 0
+        value = self.random_buffer[self.random_index]
+        self.random_index += 1
+        return value
+
+    def get_state(self, snake, food, snake_set):
+        """Convert game state (snake and food positions) into a simplified representation.
+
+        The features are packed into the bits of a single int, lowest bit first:
+        dangers left/right/up/down, food right/left/below/above, then a 2-bit food distance bucket
+        (0: close, 1: medium distance, 2: far, 3: farther).
+
+        `snake_set` holds the same cells as `snake` so danger checks are hash lookups.
+        """
         head_x, head_y = snake[0]
         food_x, food_y = food
-
-        # Determine dangers
-        dangers = {
-            'left': (head_x - SNAKE_SIZE, head_y) in snake or head_x - SNAKE_SIZE < 0,
-            'right': (head_x + SNAKE_SIZE, head_y) in snake or head_x + SNAKE_SIZE >= GAME_WIDTH,
-            'up': (head_x, head_y - SNAKE_SIZE) in snake or head_y - SNAKE_SIZE < 0,
-            'down': (head_x, head_y + SNAKE_SIZE) in snake or head_y + SNAKE_SIZE >= GAME_HEIGHT,
-        }
-
-        # Calculate relative food position
-        food_direction = (
-            head_x < food_x,  # Food is to the right
-            head_x > food_x,  # Food is to the left
-            head_y < food_y,  # Food is below
-            head_y > food_y,  # Food is above
-        )
+        left_x = head_x - SNAKE_SIZE
+        right_x = head_x + SNAKE_SIZE
+        up_y = head_y - SNAKE_SIZE
+        down_y = head_y + SNAKE_SIZE
 
         # Calculate Manhattan distance to food
         manhattan_distance = abs(head_x - food_x) + abs(head_y - food_y)
 
-        # Return state tuple
-        state = (
-            dangers['left'],
-            dangers['right'],
-            dangers['up'],
-            dangers['down'],
-            *food_direction,
-            manhattan_distance < 100,  # Food is close
-            manhattan_distance < 200,  # Food is medium distance
-            manhattan_distance < 300,  # Food is far
-        )
+        # Set each feature bit directly instead of building intermediate containers
+        state = 0
+        if left_x < 0 or (left_x, head_y) in snake_set:
+            state |= 1 << 0  # Danger left
+        if right_x >= GAME_WIDTH or (right_x, head_y) in snake_set:
+            state |= 1 << 1  # Danger right
+        if up_y < 0 or (head_x, up_y) in snake_set:
+            state |= 1 << 2  # Danger up
+        if down_y >= GAME_HEIGHT or (head_x, down_y) in snake_set:
+            state |= 1 << 3  # Danger down
+        if head_x < food_x:
+            state |= 1 << 4  # Food is to the right
+        elif head_x > food_x:
+            state |= 1 << 5  # Food is to the left
+        if head_y < food_y:
+            state |= 1 << 6  # Food is below
+        elif head_y > food_y:
+            state |= 1 << 7  # Food is above
+        if manhattan_distance >= 300:
+            state |= 3 << 8  # Food is farther
+        elif manhattan_distance >= 200:
+            state |= 2 << 8  # Food is far
+        elif manhattan_distance >= 100:
+            state |= 1 << 8  # Food is medium distance
         return state
 
-    def get_valid_actions(self, state):
-        """Get list of valid actions that won't cause immediate collision."""
-        valid_actions = []
-        dangers = {
-            'Left': state[0],
-            'Right': state[1],
-            'Up': state[2],
-            'Down': state[3]
-        }
-        
-        for action in ACTIONS:
-            if not dangers[action]:  # If there's no danger in that direction
-                valid_actions.append(action)
-                
-        return valid_actions if valid_actions else ACTIONS  # If no valid moves, return all actions
-
     def choose_action(self, state):
-        """Choose an action based on epsilon-greedy policy, avoiding invalid moves."""
-        valid_actions = self.get_valid_actions(state)
+        """Choose an action index based on epsilon-greedy policy, avoiding invalid moves."""
+        danger_bits = state & 0xF
         
-        if np.random.uniform(0, 1) < EPSILON:
-            return random.choice(valid_actions)  # Exploration among valid actions
+        if self.random_uniform() < self.epsilon:
+            # Exploration among valid actions
+            valid_actions = VALID_ACTIONS[danger_bits]
+            return valid_actions[int(self.random_uniform() * len(valid_actions))]
         else:
-            q_values = self.q_table.get(state, [0] * len(ACTIONS))
-            # Filter Q-values to only consider valid actions
-            valid_q_values = [(i, q) for i, q in enumerate(q_values) if ACTIONS[i] in valid_actions]
-            if valid_q_values:
-                # Choose the best valid action
-                best_action_idx = max(valid_q_values, key=lambda x: x[1])[0]
-                return ACTIONS[best_action_idx]
-            else:
-                # If no valid actions in Q-table, choose randomly from valid actions
-                return random.choice(valid_actions)
-
-    def learn(self, state, action, reward, next_state):
-        """Update Q-table using Q-learning rule."""
-        action_index = ACTIONS.index(action)
-        q_values = self.q_table.get(state, [0] * len(ACTIONS))
+            q_values = self.q_table.get(state, ZERO_Q_VALUES)
+            # Mask out invalid actions and choose the best valid one
+            masked_q_values = np.where(VALID_ACTION_MASKS[danger_bits], q_values, -np.inf)
+            return int(np.argmax(masked_q_values))
 
-        # Get the Q-value for the current state-action pair
-        current_q = q_values[action_index]
-        next_q_values = self.q_table.get(next_state, [0] * len(ACTIONS))
+    def learn(self, state, action_index, reward, next_state):
+        """Update Q-table using Q-learning rule."""
+        q_values = self.q_table.get(state, ZERO_Q_VALUES)
+        next_q_values = self.q_table.get(next_state, ZERO_Q_VALUES)
 
         # Q-learning update rule
-        q_values[action_index] = current_q + ALPHA * (reward + GAMMA * np.max(next_q_values) - current_q)
+        delta = q_delta(q_values, next_q_values, action_index, float(reward), ALPHA, GAMMA)
 
-        # Store updated Q-values in the table
-        self.q_table[state] = q_values
+        # Only store an unseen state once it gets a non-trivial update
+        if q_values is ZERO_Q_VALUES:
+            if abs(delta) < MIN_Q_UPDATE:
+                return
+            q_values = self.q_table[state]  # Created on first visit and updated in place
+        q_values[action_index] += delta
 
 class SnakeGame:
     def __init__(self, root, agent):
@@ -156,8 +210,10 @@ class SnakeGame:
         self.game_over = False
         self.agent = agent
         self.food_position = None
+        self.cached_state = None  # State after the last move, reused as the next step's state
         self.current_speed = SPEEDS["Normal"]
         self.training_mode = True
+        self.rng = np.random.default_rng()
 
         # Create main frame
         self.main_frame = ttk.Frame(self.root)
@@ -190,6 +246,12 @@ class SnakeGame:
                                             variable=self.training_var)
         self.training_check.pack(side=tk.LEFT, padx=5)
 
+        # Rendering toggle, turning it off runs the game as fast as possible
+        self.render_var = tk.BooleanVar(value=True)
+        self.render_check = ttk.Checkbutton(self.control_panel, text="Render", 
+                                          variable=self.render_var, command=self.toggle_render)
+        self.render_check.pack(side=tk.LEFT, padx=5)
+
         # Restart button
         self.restart_button = ttk.Button(self.control_panel, text="Restart", command=self.restart_game)
         self.restart_button.pack(side=tk.RIGHT, padx=5)
@@ -199,7 +261,8 @@ class SnakeGame:
         self.canvas.pack(padx=5, pady=5)
 
         # Initialize snake and food
-        self.snake = [(100, 100), (80, 100), (60, 100)]
+        self.snake = deque([(100, 100), (80, 100), (60, 100)])
+        self.snake_set = set(self.snake)
         self.food = None
         self.direction = "Right"
         self.create_objects()
@@ -211,6 +274,9 @@ class SnakeGame:
         self.root.bind("<Down>", lambda e: self.change_direction("Down"))
         self.root.bind("<space>", lambda e: self.restart_game())
 
+        # Save the Q-table on exit so episodes since the last save are not lost
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
         # Start the game
         self.run_game()
 
@@ -227,53 +293,65 @@ class SnakeGame:
 
     def create_objects(self):
         """Create snake and food objects in the canvas."""
-        self.snake_body = []
+        self.snake_body = deque()
+        self.draw_snake()
+        self.spawn_food()
+
+    def draw_snake(self):
+        """Create a rectangle in the canvas for every snake segment."""
         for segment in self.snake:
             self.snake_body.append(self.canvas.create_rectangle(segment[0], segment[1], segment[0] + SNAKE_SIZE,
                                                                 segment[1] + SNAKE_SIZE, fill="green"))
 
-        self.spawn_food()
+    def toggle_render(self):
+        """Redraw the snake when rendering is turned back on."""
+        if self.render_var.get():
+            for segment in self.snake_body:
+                self.canvas.delete(segment)
+            self.snake_body.clear()
+            self.draw_snake()
 
     def spawn_food(self):
         """Place the food at a random position on the canvas."""
-        food_x = random.randint(0, (GAME_WIDTH // FOOD_SIZE) - 1) * FOOD_SIZE
-        food_y = random.randint(0, (GAME_HEIGHT // FOOD_SIZE) - 1) * FOOD_SIZE
+        food_x = int(self.rng.integers(GAME_WIDTH // FOOD_SIZE)) * FOOD_SIZE
+        food_y = int(self.rng.integers(GAME_HEIGHT // FOOD_SIZE)) * FOOD_SIZE
         self.food = self.canvas.create_rectangle(food_x, food_y, food_x + FOOD_SIZE, food_y + FOOD_SIZE, fill="red")
         self.food_position = (food_x, food_y)
 
     def move_snake(self):
         """Move the snake by updating its coordinates."""
         x, y = self.snake[0]
-
-        if self.direction == "Left":
-            x -= SNAKE_SIZE
-        elif self.direction == "Right":
-            x += SNAKE_SIZE
-        elif self.direction == "Up":
-            y -= SNAKE_SIZE
-        elif self.direction == "Down":
-            y += SNAKE_SIZE
-
-        new_head = (x, y)
-        self.snake = [new_head] + self.snake
+        dx, dy = DIRECTION_DELTAS[self.direction]
+        new_head = (x + dx, y + dy)
+        self.snake.appendleft(new_head)
 
         # Always remove the last part (we'll handle growth separately)
-        self.snake.pop()
+        tail = self.snake.pop()
+
+        # A freshly grown snake repeats its tail cell, so only forget the cell once it is vacated
+        if tail != self.snake[-1]:
+            self.snake_set.discard(tail)
+        self.snake_set.add(new_head)
 
         # Update snake body on canvas
-        self.update_snake_body()
+        if self.render_var.get():
+            self.update_snake_body()
 
     def update_snake_body(self):
-        """Update the canvas representation of the snake."""
-        # Clear the canvas and redraw the snake
-        for i, segment in enumerate(self.snake):
-            if i < len(self.snake_body):
-                self.canvas.coords(self.snake_body[i], segment[0], segment[1],
-                                   segment[0] + SNAKE_SIZE, segment[1] + SNAKE_SIZE)
-            else:
-                self.snake_body.append(self.canvas.create_rectangle(segment[0], segment[1], 
-                                                                    segment[0] + SNAKE_SIZE,
-                                                                    segment[1] + SNAKE_SIZE, fill="green"))
+        """Update the canvas representation of the snake.
+
+        Only the head changes between moves, so a single rectangle is moved or created per call.
+        """
+        head_x, head_y = self.snake[0]
+        if len(self.snake_body) < len(self.snake):
+            # The snake has grown, add a new rectangle for the head
+            head = self.canvas.create_rectangle(head_x, head_y, head_x + SNAKE_SIZE,
+                                                head_y + SNAKE_SIZE, fill="green")
+        else:
+            # Reuse the tail rectangle as the new head
+            head = self.snake_body.pop()
+            self.canvas.coords(head, head_x, head_y, head_x + SNAKE_SIZE, head_y + SNAKE_SIZE)
+        self.snake_body.appendleft(head)
 
     def food_collision(self):
         """Check if the snake's head has collided with the food."""
@@ -294,48 +372,63 @@ class SnakeGame:
         if head_x < 0 or head_x >= GAME_WIDTH or head_y < 0 or head_y >= GAME_HEIGHT:
             self.game_over = True
 
-        # Check self-collision
-        if (head_x, head_y) in self.snake[1:]:
+        # Check self-collision: the head landing on the body leaves one cell shared by two segments
+        if len(self.snake_set) < len(self.snake):
             self.game_over = True
 
     def run_game(self):
         """Main game loop with Reinforcement Learning."""
         if not self.game_over:
-            state = self.agent.get_state(self.snake, self.food_position)
-            
-            # Only use RL agent in training mode
-            if self.training_var.get():
-                action = self.agent.choose_action(state)
-                self.direction = action
-            else:
-                # Manual control in non-training mode
-                pass
-
-            # Move the snake
-            self.move_snake()
-
-            # Check for collisions
-            self.check_collisions()
-
-            # Check for food collision
-            ate_food = self.food_collision()
-
-            # If food is eaten, grow the snake
-            if ate_food:
-                self.snake.append(self.snake[-1])
-                self.score += 10
-                self.update_score_display()
-
-            # Update Q-table if in training mode
-            if self.training_var.get():
-                next_state = self.agent.get_state(self.snake, self.food_position)
-                reward = self.calculate_reward(ate_food)
-                self.agent.learn(state, action, reward, next_state)
-
-            self.root.after(self.current_speed, self.run_game)
+            # Without rendering, run a batch of steps per callback and leave Tk a gap between
+            # batches so its idle callbacks can still redraw the window
+            steps = 1 if self.render_var.get() else HEADLESS_BATCH_SIZE
+            for _ in range(steps):
+                self.step_game()
+                if self.game_over:
+                    break
+
+            self.root.after(self.current_speed if self.render_var.get() else 1, self.run_game)
         else:
             self.end_game()
 
+    def step_game(self):
+        """Advance the game by one step, letting the agent act and learn in training mode."""
+        state = self.cached_state
+        if state is None:
+            state = self.agent.get_state(self.snake, self.food_position, self.snake_set)
+        
+        # Only use RL agent in training mode
+        if self.training_var.get():
+            action_index = self.agent.choose_action(state)
+            self.direction = ACTIONS[action_index]
+        else:
+            # Manual control in non-training mode
+            pass
+
+        # Move the snake
+        self.move_snake()
+
+        # Check for collisions
+        self.check_collisions()
+
+        # Check for food collision
+        ate_food = self.food_collision()
+
+        # If food is eaten, grow the snake
+        if ate_food:
+            self.snake.append(self.snake[-1])
+            self.score += 10
+            self.update_score_display()
+
+        # Update Q-table if in training mode
+        if self.training_var.get():
+            next_state = self.agent.get_state(self.snake, self.food_position, self.snake_set)
+            reward = self.calculate_reward(ate_food)
+            self.agent.learn(state, action_index, reward, next_state)
+            self.cached_state = next_state
+        else:
+            self.cached_state = None
+
     def calculate_reward(self, ate_food):
         """Enhanced reward system for RL."""
         if self.game_over:
@@ -372,15 +465,17 @@ class SnakeGame:
                               text=f"Game Over!\nScore: {self.score}\nHigh Score: {self.high_score}",
                               fill="white", font=("Arial", 24), justify=tk.CENTER)
         
-        # Save Q-table when the game ends
+        # Save Q-table every few episodes
         if self.training_var.get():
-            self.agent.save_q_table()
+            self.agent.episode += 1
+            if self.agent.episode % self.agent.save_every == 0:
+                self.agent.save_q_table()
+
+        # Decay the exploration rate
+        self.agent.epsilon = max(self.agent.epsilon_min, self.agent.epsilon * self.agent.epsilon_decay)
 
-        global EPSILON
-        if EPSILON > EPSILON_MIN:
-            EPSILON *= EPSILON_DECAY
         # Restart the game for continuous learning
-        self.root.after(2000, self.restart_game)
+        self.root.after(2000 if self.render_var.get() else 1, self.restart_game)
 
     def restart_game(self):
         """Restart the game with initial values."""
@@ -392,13 +487,20 @@ class SnakeGame:
         self.canvas.delete("all")
         
         # Reset snake and food
-        self.snake = [(100, 100), (80, 100), (60, 100)]
+        self.snake = deque([(100, 100), (80, 100), (60, 100)])
+        self.snake_set = set(self.snake)
+        self.cached_state = None
         self.direction = "Right"
         self.create_objects()
         
         # Start the game again
         self.run_game()
 
+    def close(self):
+        """Save the Q-table and close the window."""
+        self.agent.save_q_table()
+        self.root.destroy()
+
     def change_direction(self, new_direction):
         """Change the snake's direction if valid."""
         if not self.training_var.get():  # Only allow manual control in non-training mode
@@ -410,7 +512,7 @@ if __name__ == "__main__":
     root = tk.Tk()
     
     # Create and configure the agent
-    state_size = 11  # Updated state size with new features
+    state_size = 10  # Number of bits in the packed state
     action_size = len(ACTIONS)
     agent = QLearningSnakeAgent(state_size, action_size)
     